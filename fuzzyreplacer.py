@@ -2,124 +2,291 @@
 # Copyright (C) 2022 J. Férard <https://github.com/jferard>
 # License: GPLv3
 
-import difflib
+import array
+import functools
+import itertools
 import re
-from typing import Mapping, List, Union, Callable, Optional
+import sys
+import unicodedata
+from collections import Counter
+from typing import (Mapping, List, Union, Callable, Optional, Dict,
+                    Iterable, Tuple, NamedTuple)
 
+try:
+    from rapidfuzz import process as fuzz_process
+    from rapidfuzz.distance import Indel
+except ImportError:
+    Indel = None
+    fuzz_process = None
 
-class Match:
+
+class Match(NamedTuple):
     """
     A match
     """
+    # index of first word of match
+    i: int
+    # index of last word of match + 1
+    j: int
+    # expression to replace the match
+    s: str
+    # score of the match
+    score: float
 
-    def __init__(self, i: int, j: int, s: str, score: float):
-        """
 
-        :param i: index of first word of match
-        :param j: index of last word of match + 1
-        :param s: expression to replace the match
-        :param score: score of the match
-        """
-        self.i = i
-        self.j = j
-        self.s = s
-        self.score = score
+def select_matches(matches: List[Match]) -> List[Match]:
+    """
+    Select the best matches. A match should not overlap another. A match should
+    be as long as possible.
+    :param matches: the matches
+    :return: the selected matches
+    """
+    if not matches:
+        return []
+
+    selected_matches = []
+    cur_winner = matches[0]
+    # the current winner, unpacked once, and its weighted score (the score
+    # weighted by the length of the match)
+    cur_i, cur_j, _, cur_score = cur_winner
+    cur_ws = cur_score * (cur_j - cur_i)
+    for winner in itertools.islice(matches, 1, None):
+        i, j, _, score = winner
+        if i == cur_i:
+            ws = score * (j - i)
+            if ws > cur_ws:
+                cur_winner = winner
+                cur_j = j
+                cur_ws = ws
+        elif i >= cur_j:
+            selected_matches.append(cur_winner)
+            cur_winner = winner
+            cur_i = i
+            cur_j = j
+            cur_ws = score * (j - i)
+    selected_matches.append(cur_winner)
+    return selected_matches
 
-    def weighted_score(self) -> float:
-        """
-        :return: the score weighted by the length of the match
-        """
-        return self.score * (self.j - self.i)
 
-    def __len__(self) -> int:
-        return self.j - self.i
+WORD_REGEX = re.compile(r"\w+")
+# the replacements of a node are stored under this key, apart from the chunks
+VALUES = None
+Tree = Mapping[Optional[str], Union["Tree", List[str]]]
 
-    def __eq__(self, other) -> bool:
-        return isinstance(other,
-                          Match) and other.i == self.i and other.j == self.j and self.s == other.s
 
-    def __repr__(self) -> str:
-        return "Match({}:{}, {}, ws={})".format(self.i, self.j, self.s,
-                                                self.weighted_score())
+def dict_to_tree(d: Mapping[str, str], func: Callable[[str], str]
+                 ) -> Tree:
+    root = {}
+    for k, v in d.items():
+        chunks = k.split()
+        if not chunks:
+            # an empty expression would replace every single word
+            continue
+
+        cur = root
+        for chunk in chunks:
+            # the same chunk is shared by many keys (sys.intern only accepts
+            # exact str values)
+            cur = cur.setdefault(sys.intern(str(func(chunk))), {})
+        values = cur.setdefault(VALUES, [])
+        if v not in values:
+            values.append(v)
+    return root
 
 
-class State:
+class LazyDict(dict):
     """
-    Current state in the dict
+    A dict whose missing values are computed on first use.
     """
 
-    def __init__(self, i: int, d: Mapping[str, str], score: float):
+    def __init__(self, func: Callable[[str], object]):
         """
-
-        :param i: the start of the match
-        :param d: the subtree of level 1
-        :param score: the score
+        :param func: the function that computes the value of a key
         """
-        self.i = i
-        self.d = d
-        self.score = score
+        super().__init__()
+        self._func = func
+
+    def __missing__(self, key: str) -> object:
+        value = self._func(key)
+        self[key] = value
+        return value
+
 
-    def items(self):
-        return self.d.items()
+class FlatTree:
+    """
+    The tree of expressions, flattened: the nodes are numbered in breadth
+    first order (the root is the node 0), and the edges of a node are
+    stored contiguously, in flat arrays. The edges of the node `n` are the
+    indices `edge_starts[n]` to `edge_ends[n] - 1` of `chunks` and
+    `children`; `values[n]` are the replacements of the expressions that end
+    at `n`. `counter_by_chunk` and `masks_by_chunk` hold the characters and
+    the `char_masks` of the chunks, computed on first use.
+    """
 
-    def as_match(self, j: int, s: str) -> "Match":
+    def __init__(self, root: Tree):
         """
-        :param j: last indec
-        :param s: the replacement
-        :return: a match
+        :param root: the tree of expressions
         """
-        return Match(self.i, j, s, self.score)
-
-    def update(self, v: Mapping[str, str], score: float):
+        self.edge_starts = array.array('i')
+        self.edge_ends = array.array('i')
+        self.chunks = []
+        self.children = array.array('i')
+        self.values = []
+        subtrees = [root]
+        # subtrees grows while we iterate over it
+        for subtree in subtrees:
+            self.edge_starts.append(len(self.chunks))
+            for k, v in subtree.items():
+                if k is not VALUES:
+                    self.chunks.append(k)
+                    self.children.append(len(subtrees))
+                    subtrees.append(v)
+            self.edge_ends.append(len(self.chunks))
+            self.values.append(tuple(subtree.get(VALUES, ())))
+        # only the pure Python scoring reads them
+        self.counter_by_chunk = LazyDict(Counter)
+        self.masks_by_chunk = LazyDict(char_masks)
+
+    def edges(self, node: int) -> range:
         """
-        Advance one step in the tree
-        :param v: the subtree
-        :param score: the next score
+        :param node: the index of the node
+        :return: the indices of the edges of the node
         """
+        return range(self.edge_starts[node], self.edge_ends[node])
 
-        assert v is not None
-        return State(self.i, v, self.score * score)
 
-    def __repr__(self) -> str:
-        return "State({}, {})".format(self.i, self.d)
+def quick_bound(word_counter: Mapping[str, int],
+                chunk_counter: Mapping[str, int], lw: int, lc: int) -> float:
+    """
+    An upper bound of the ratio, from the characters the word and the chunk
+    have in common (this is SequenceMatcher.quick_ratio).
+    :param word_counter: the characters of the word
+    :param chunk_counter: the characters of the chunk
+    :param lw: the length of the word
+    :param lc: the length of the chunk
+    :return: the bound
+    """
+    common = 0
+    for c, n in chunk_counter.items():
+        m = word_counter.get(c)
+        if m:
+            common += n if n < m else m
+    # same formula as indel_ratio, so that the bound is never below the ratio
+    total = lw + lc
+    return 1 - (total - 2 * common) / total
 
 
-def select_matches(matches: List[Match]) -> List[Match]:
+def char_masks(s: str) -> Dict[str, int]:
     """
-    Select the best matches. A match should not overlap another. A match should
-    be as long as possible.
-    :param matches: the matches
-    :return: the selected matches
+    :param s: a string
+    :return: for every character, the bit mask of its positions in `s`
     """
-    if not matches:
-        return []
+    masks = {}
+    for k, c in enumerate(s):
+        masks[c] = masks.get(c, 0) | 1 << k
+    return masks
 
-    selected_matches = []
-    cur_winner = matches[0]
-    for winner in matches[1:]:
-        if winner.i == cur_winner.i and winner.weighted_score() > cur_winner.weighted_score():
-            cur_winner = winner
-        elif winner.i >= cur_winner.j:
-            selected_matches.append(cur_winner)
-            cur_winner = winner
-    selected_matches.append(cur_winner)
-    return selected_matches
 
+def indel_ratio(masks: Mapping[str, int], lm: int, s: str) -> float:
+    """
+    The normalized Indel similarity `1 - (total - 2 * LCS) / total`, where
+    `total = lm + len(s)`. This is computed exactly as
+    rapidfuzz.distance.Indel.normalized_similarity, to get the same floats.
+    The length of the longest common subsequence is computed with the
+    bit-parallel algorithm of Hyyrö.
+    :param masks: the `char_masks` of the other string
+    :param lm: the length of the other string
+    :param s: the string
+    :return: the ratio (between 0 and 1)
+    """
+    full = (1 << lm) - 1
+    v = full
+    for c in s:
+        u = v & masks.get(c, 0)
+        v = ((v + u) | (v - u)) & full
+    lcs = lm - bin(v).count("1")
+    total = lm + len(s)
+    return 1 - (total - 2 * lcs) / total
+
+
+def score_chunks(word: str, chunks: Iterable[str], cutoff: float,
+                 counter_by_chunk: Optional[Mapping[str, Counter]] = None,
+                 masks_by_chunk: Optional[Mapping[str, Dict[str, int]]] = None
+                 ) -> Dict[str, float]:
+    """
+    Score all the chunks against a word in one pass.
+    :param word: the normalized word
+    :param chunks: the keys of the tree
+    :param cutoff: the ratio cutoff (between 0 and 1)
+    :param counter_by_chunk: the precomputed characters of the chunks, if any
+    :param masks_by_chunk: the precomputed `char_masks` of the chunks, if any
+    :return: the score of every chunk that reaches the cutoff
+    """
+    score_by_chunk = {}
+    candidates = []
+    lw = len(word)
+    for chunk in chunks:
+        if chunk == word:
+            score_by_chunk[chunk] = 1.0
+        else:
+            # same bound as SequenceMatcher.real_quick_ratio, with the
+            # formula of indel_ratio
+            lc = len(chunk)
+            total = lc + lw
+            if 1 - (total - 2 * min(lc, lw)) / total >= cutoff:
+                candidates.append(chunk)
+
+    if not candidates:
+        return score_by_chunk
+
+    if fuzz_process is not None:
+        # rapidfuzz prunes internally and drops the chunks below the cutoff.
+        # The words are already normalized: no processor (rapidfuzz 2.x
+        # applied default_process by default).
+        for chunk, score, _ in fuzz_process.extract(
+                word, candidates, scorer=Indel.normalized_similarity,
+                processor=None, score_cutoff=cutoff, limit=None):
+            if score:
+                score_by_chunk[chunk] = score
+        return score_by_chunk
 
-SPLIT_REGEX = re.compile(r"(\W+)")
-Tree = Union[Mapping[str, "Tree"], Mapping[str, None]]
+    word_counter = Counter(word)
+    for chunk in candidates:
+        if counter_by_chunk is None:
+            chunk_counter = Counter(chunk)
+        else:
+            chunk_counter = counter_by_chunk[chunk]
+        lc = len(chunk)
+        # real_quick_ratio was checked above; quick_bound is the cheap filter
+        if quick_bound(word_counter, chunk_counter, lw, lc) >= cutoff:
+            # the chunks are known in advance: they hold the masks
+            if masks_by_chunk is None:
+                chunk_masks = char_masks(chunk)
+            else:
+                chunk_masks = masks_by_chunk[chunk]
+            ratio = indel_ratio(chunk_masks, lc, word)
+            if ratio >= cutoff:
+                score_by_chunk[chunk] = ratio
+    return score_by_chunk
+
+
+class AsciiFoldTable(dict):
+    """
+    A `str.translate` table that maps a code point to its lowercase ASCII
+    letters: NFKD decomposition, then non ASCII and non alphabetic characters
+    are removed. The entries are computed on first use.
+    """
 
+    def __missing__(self, code_point: int) -> str:
+        folded = unicodedata.normalize(
+            'NFKD', chr(code_point)).encode('ascii', 'ignore').decode(
+            'ascii', 'ignore').lower()
+        folded = ''.join([c for c in folded if c.isalpha()])
+        self[code_point] = folded
+        return folded
 
-def dict_to_tree(d: Mapping[str, str], func: Callable[[str], str]
-                 ) -> Tree:
-    root = {}
-    for k, v in d.items():
-        cur = root
 
-        for chunk in k.split():
-            cur = cur.setdefault(func(chunk), {})
-        cur[v] = None
-    return root
+ASCII_FOLD_TABLE = AsciiFoldTable()
 
 
 class FuzzyReplacerHelper:
@@ -127,18 +294,25 @@ class FuzzyReplacerHelper:
     A helper class.
     """
 
-    def __init__(self, root: Tree,
+    def __init__(self, tree: FlatTree,
                  normalize_func: Callable[[str], str], cutoff: float):
         """
-        :param root: the tree of expressions
+        :param tree: the flat tree of expressions
         :param normalize_func: the function to normalize
-        :param cutoff: the difflib cutoff
+        :param cutoff: the ratio cutoff (between 0 and 1)
         """
-        self._root = root
+        self._tree = tree
         self._normalize = normalize_func
         self._cutoff = cutoff
-        self._states = []
+        # the current states, as parallel lists: the index of the node in
+        # the tree, the start of the match and the score
+        self._nodes = []
+        self._starts = []
+        self._scores = []
         self._matches = []
+        # word -> node -> ((child, score), ...) (only the scores above the
+        # cutoff, so the rejected chunks of a word are not kept)
+        self._transitions_by_node_by_word = {}
 
     def process(self, words: List[str]) -> List[Match]:
         """
@@ -150,48 +324,76 @@ class FuzzyReplacerHelper:
             word = self._normalize(word)
             self._consume(i, word)
 
-        for state in self._states:
-            for k, v in state.items():
-                if v is None:
-                    self._matches.append(state.as_match(len(words), k))
+        values = self._tree.values
+        j = len(words)
+        for node, start, score in zip(self._nodes, self._starts,
+                                      self._scores):
+            for k in values[node]:
+                self._matches.append(Match(start, j, k, score))
 
         return self._matches
 
     def _consume(self, i: int, word: str):
-        s = difflib.SequenceMatcher()
-        s.set_seq2(word)
-
-        cutoff = self._cutoff
-
-        def word_matches(chunk: str) -> Optional[float]:
-            s.set_seq1(chunk)
-            if (s.real_quick_ratio() >= cutoff
-                    and s.quick_ratio() >= cutoff):
-                ratio = s.ratio()
-                if ratio >= cutoff:
-                    return ratio
-
-            return None
-
-        new_states = []
-        # try root
-        for k, v in self._root.items():
-            if v is None:
-                self._matches.append(Match(i, i + 1, k, 0))
-            score = word_matches(k)
-            if score:
-                new_states.append(State(i, v, score))
+        transitions_by_node = self._transitions(word)
+        matches = self._matches
+        values = self._tree.values
+
+        new_nodes = []
+        new_starts = []
+        new_scores = []
+        # try root (there is no replacement at the root)
+        for child, score in transitions_by_node[0]:
+            new_nodes.append(child)
+            new_starts.append(i)
+            new_scores.append(score)
 
         # continue where we left
-        for state in self._states:
-            for k, v in state.items():
-                if v is None:
-                    self._matches.append(state.as_match(i, k))
-                score = word_matches(k)
+        for node, start, state_score in zip(self._nodes, self._starts,
+                                            self._scores):
+            for k in values[node]:
+                matches.append(Match(start, i, k, state_score))
+            for child, score in transitions_by_node[node]:
+                new_nodes.append(child)
+                new_starts.append(start)
+                new_scores.append(state_score * score)
+
+        self._nodes = new_nodes
+        self._starts = new_starts
+        self._scores = new_scores
+
+    def _transitions(self, word: str
+                     ) -> Dict[int, Tuple[Tuple[int, float], ...]]:
+        """
+        :param word: the normalized word
+        :return: for the root and every node of the current states, the
+        children that can be reached with this word and their scores.
+        """
+        tree = self._tree
+        transitions_by_node = self._transitions_by_node_by_word.setdefault(
+            word, {})
+        nodes = set(self._nodes)
+        nodes.add(0)
+        nodes.difference_update(transitions_by_node)
+        if not nodes:
+            return transitions_by_node
+
+        # the chunks shared by several nodes are scored once
+        tree_chunks = tree.chunks
+        chunks = {tree_chunks[e] for node in nodes for e in tree.edges(node)}
+        score_by_chunk = score_chunks(word, chunks, self._cutoff,
+                                      tree.counter_by_chunk,
+                                      tree.masks_by_chunk)
+
+        tree_children = tree.children
+        for node in nodes:
+            transitions = []
+            for e in tree.edges(node):
+                score = score_by_chunk.get(tree_chunks[e])
                 if score:
-                    new_states.append(state.update(v, score))
-
-        self._states = new_states
+                    transitions.append((tree_children[e], score))
+            # the empty tuple is shared
+            transitions_by_node[node] = tuple(transitions)
+        return transitions_by_node
 
 
 class FuzzyReplacer:
@@ -205,11 +407,13 @@ class FuzzyReplacer:
         """
         :param to_by_from: the mapping
         :param normalize_func: the function to normalize
-        :param cutoff: the difflib cutoff
+        :param cutoff: the ratio cutoff (between 0 and 1)
         """
         if normalize_func is None:
             normalize_func = FuzzyReplacer._default_normalize
-        self._root = dict_to_tree(to_by_from, normalize_func)
+        # per instance cache: the words of a text are often repeated
+        normalize_func = functools.lru_cache(maxsize=8192)(normalize_func)
+        self._tree = FlatTree(dict_to_tree(to_by_from, normalize_func))
         self._normalize = normalize_func
         self._cutoff = cutoff
 
@@ -218,35 +422,30 @@ class FuzzyReplacer:
         :param s: the input string
         :return: the output string, with the matches replaced if possible
         """
-        words_and_spaces = SPLIT_REGEX.split(s)
-        if not words_and_spaces:
-            return s
-        else:
-            words = words_and_spaces[::2]
-            spaces = words_and_spaces[1::2] + ['']
+        spans = [m.span() for m in WORD_REGEX.finditer(s)]
+        words = [s[start:end] for start, end in spans]
 
-        matches = FuzzyReplacerHelper(self._root, self._normalize,
+        matches = FuzzyReplacerHelper(self._tree, self._normalize,
                                       self._cutoff).process(words)
 
         if not matches:
             return s
 
-        matches = select_matches(matches)
-        for match in reversed(matches):
-            words = words[:match.i] + [match.s] + words[match.j:]
-            spaces = spaces[:match.i] + spaces[match.j - 1:]
+        # the selected matches are sorted and do not overlap. Everything but
+        # the replacements is sliced from the input string.
+        chunks = []
+        prev_end = 0
+        for match in select_matches(matches):
+            chunks.append(s[prev_end:spans[match.i][0]])
+            chunks.append(match.s)
+            prev_end = spans[match.j - 1][1]
+        chunks.append(s[prev_end:])
 
-        return "".join(
-            [chunk for w_and_s in zip(words, spaces) for chunk in w_and_s]
-        )
+        return "".join(chunks)
 
     @staticmethod
     def _default_normalize(word: str) -> str:
-        import unicodedata
-        word = unicodedata.normalize(
-            'NFKD', word).encode('ascii', 'ignore').decode('ascii',
-                                                           'ignore').lower()
-        return ''.join([c for c in word if c.isalpha()])
+        return word.translate(ASCII_FOLD_TABLE)
 
 
 __all__ = ["FuzzyReplacer"]
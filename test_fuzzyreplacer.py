@@ -2,9 +2,17 @@
 # Copyright (C) 2022 J. Férard <https://github.com/jferard>
 # License: GPLv3
 
+import difflib
+import itertools
 import unittest
+from collections import Counter
+from unittest import mock
 
-from fuzzyreplacer import FuzzyReplacer
+import fuzzyreplacer
+
+from fuzzyreplacer import (FuzzyReplacer, score_chunks, quick_bound,
+                           indel_ratio, char_masks, FuzzyReplacerHelper,
+                           FlatTree, dict_to_tree)
 
 
 class TestFuzzyReplacerCase(unittest.TestCase):
@@ -57,6 +65,113 @@ ou GNU GPL pour faire court. On peut raccourcir encore plus en « GPL »,
 s'il est entendu qu'il s'agit de la GNU GPL.""",
                          FuzzyReplacer(mapping).process(text))
 
+    def test_replacement_is_not_a_chunk(self):
+        self.assertEqual("gpl gpl",
+                         FuzzyReplacer({"gnu gpl": "gpl"}).process(
+                             "gnu gpl gpl"))
+
+    def test_replacement_equals_a_chunk(self):
+        for mapping in ({"gnu gpl": "X", "gnu": "gpl"},
+                        {"gnu": "gpl", "gnu gpl": "X"}):
+            replacer = FuzzyReplacer(mapping)
+            self.assertEqual("a X b", replacer.process("a gnu gpl b"))
+            self.assertEqual("a gpl b", replacer.process("a gnu b"))
+
+    def test_edge_separators_are_not_words(self):
+        # "_" normalizes to "", but the separators at the ends of the text
+        # are not empty words that it could match
+        self.assertEqual("« generale-x1. w",
+                         FuzzyReplacer({"_": "GPL"}).process(
+                             "« generale-x1. w"))
+        self.assertEqual("... abc publique, ",
+                         FuzzyReplacer({"abc publiqu _": "X"}).process(
+                             "... abc publique, "))
+
+    def test_empty_key(self):
+        self.assertEqual("hello G world",
+                         FuzzyReplacer({"": "X", "gnu": "G"}).process(
+                             "hello gnu world"))
+
+    def test_normalize_returns_str_subclass(self):
+        class Word(str):
+            pass
+
+        self.assertEqual("a GPL b",
+                         FuzzyReplacer({"gnu gpl": "GPL"},
+                                       lambda w: Word(w.lower())).process(
+                             "a GNU GPL b"))
+
+    def test_default_normalize(self):
+        self.assertEqual("generalelicence",
+                         FuzzyReplacer._default_normalize(
+                             "Générale-LICENCE\u0301 ½ ß"))
+
+
+class TestScoreChunksCase(unittest.TestCase):
+    def test_score_chunks(self):
+        score_by_chunk = score_chunks(
+            "general", ["general", "generale", "gen", "licence"], 0.85)
+
+        self.assertEqual({"general", "generale"}, set(score_by_chunk))
+        self.assertEqual(1.0, score_by_chunk["general"])
+        self.assertAlmostEqual(14 / 15, score_by_chunk["generale"])
+
+    @unittest.skipIf(fuzzyreplacer.fuzz_process is None,
+                     "rapidfuzz is not installed")
+    def test_backends_agree(self):
+        words = ["general", "generale", "licence", "licens", "publiqu",
+                 "public", "gnu", "x"]
+        mapping = {"licence publiqu general": "GPL", "licence publique": "PL",
+                   "gnu gpl": "GPL"}
+        text = ("la licence publique générale GNU, ou gnu gpl, "
+                "ou licens public")
+
+        def run():
+            return ([score_chunks(word, words, 0.7) for word in words],
+                    FuzzyReplacer(mapping).process(text),
+                    # a tie of weighted scores, broken by the last ulp
+                    FuzzyReplacer({"d cd ae": "Q", "adcd ad": "Y",
+                                   "edaed": "Q", "ca cb a": "Y"},
+                                  cutoff=0.5).process("ad d a aaca eeae"))
+
+        rapidfuzz_results = run()
+        with mock.patch.object(fuzzyreplacer, "fuzz_process", None):
+            fallback_results = run()
+
+        self.assertEqual(rapidfuzz_results, fallback_results)
+
+    def test_no_processor(self):
+        # with a custom normalize function, the case is significant
+        self.assertEqual({"GPL": 1.0},
+                         score_chunks("GPL", ["GPL", "gpl"], 0.5))
+
+    def test_quick_bound(self):
+        s = difflib.SequenceMatcher(None, "publique", "pubilc")
+        self.assertAlmostEqual(s.quick_ratio(),
+                               quick_bound(Counter("pubilc"),
+                                           Counter("publique"), 6, 8))
+
+    def test_indel_ratio(self):
+        # LCS("publique", "pubilc") = "publ"
+        self.assertAlmostEqual(8 / 14,
+                               indel_ratio(char_masks("pubilc"), 6,
+                                           "publique"))
+
+
+class TestFuzzyReplacerHelperCase(unittest.TestCase):
+    def test_cache_keeps_only_transitions(self):
+        # the memory of the cache must not grow as words x rejected chunks
+        keys = ["".join(p) for p in itertools.permutations("abcde", 4)]
+        words = ["".join(p) for p in itertools.permutations("vwxyz", 4)]
+        tree = FlatTree(dict_to_tree({k: "X" for k in keys}, str))
+        helper = FuzzyReplacerHelper(tree, str, 0.85)
+
+        self.assertEqual([], helper.process(words))
+        transitions_by_node_by_word = helper._transitions_by_node_by_word
+        self.assertEqual(len(words), len(transitions_by_node_by_word))
+        for transitions_by_node in transitions_by_node_by_word.values():
+            self.assertEqual({0: ()}, transitions_by_node)
+
 
 if __name__ == '__main__':
     unittest.main()